@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''
+Consul user event watcher
+
+:maintainer: Aaron Bell <aarontbellgmail.com>
+:maturity: new
+:depends:    - python-consul (http://python-consul.readthedocs.org/en/latest/)
+:platform: Linux
+
+:configuration: See :py:mod:`salt.modules.consul` for setup instructions.
+    The consul execution module must be synced to the minion as well.
+
+Watches the local agent for user events with blocking queries, and on
+each new event invalidates the consul snapshot cache entries overlapping
+the key prefix carried in its payload (all of them for an empty payload),
+optionally refreshing pillar too. One event fired anywhere in the cluster
+then replaces every minion polling every key. Invalidated snapshots are
+only fetched again when next read, so the fleet does not hit consul all at
+once.
+
+.. code-block:: yaml
+
+    engines:
+      - consul_events:
+          name: salt-invalidate
+          refresh_pillar: True
+
+Fire an event to invalidate ``config/myapp/`` on every minion:
+
+.. code-block:: bash
+
+    salt-call consul.event_fire salt-invalidate payload=config/myapp/
+'''
+
+import math
+import time
+import random
+import logging
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'consul_events'
+
+
+def __virtual__():
+    '''
+    Only load if the consul module is in __salt__
+    '''
+    if 'consul.event_list' in __salt__:
+        return __virtualname__
+    return False
+
+
+def _handle(event):
+    '''
+    Applies one user event
+    '''
+    prefix = event.get('Payload') or ''
+    invalidated = __salt__['consul.cache_invalidate'](prefix)
+    log.info('Consul event %s invalidated cache prefixes %s', event['ID'], invalidated)
+
+
+def _refresh_pillar():
+    try:
+        __salt__['saltutil.refresh_pillar']()
+    except Exception as exc:
+        log.warning('Unable to refresh pillar: %s', exc)
+
+
+def start(name='salt-invalidate', refresh_pillar=False, splay=30, wait='5m', retry=10):
+    '''
+    Watch for user events called name
+
+    name
+        name of the user events to act on
+
+    refresh_pillar
+        also refresh pillar after events
+
+    splay
+        pillar is refreshed a random number of seconds up to splay after an
+        event, so minions do not all refresh at the same moment. Events
+        arriving meanwhile share that one refresh.
+
+    wait
+        how long each blocking query waits for a new event
+
+    retry
+        seconds to wait before retrying after an error
+    '''
+    index = None
+    seen = None
+    refresh_at = None
+    while True:
+        if refresh_at is not None and time.time() >= refresh_at:
+            refresh_at = None
+            _refresh_pillar()
+
+        query_wait = wait
+        if refresh_at is not None:
+            # come back in time for the pending pillar refresh
+            query_wait = '%ds' % max(1, int(math.ceil(refresh_at - time.time())))
+        try:
+            ret = __salt__['consul.event_list'](name=name, index=index, wait=query_wait)
+        except Exception as exc:
+            log.warning('Unable to list consul events: %s', exc)
+            time.sleep(retry)
+            continue
+
+        # the agent keeps a ring buffer of recent events, so anything it
+        # returns that was not there last time is new. Events from before
+        # the watcher started are not replayed.
+        ids = set([event['ID'] for event in ret['events']])
+        if seen is not None:
+            for event in ret['events']:
+                if event['ID'] not in seen:
+                    try:
+                        _handle(event)
+                    except Exception as exc:
+                        log.warning('Unable to handle consul event %s: %s', event['ID'], exc)
+                    if refresh_pillar and refresh_at is None:
+                        refresh_at = time.time() + random.uniform(0, float(splay))
+        seen = ids
+        index = ret['index']
@@ -13,22 +13,120 @@ Execution module to provide consul functionality to Salt
     consul.port: 8500
     consul.consistency: 'default'
     consul.token: 'ySsVJuvjBOZzqnP5zVPs3A=='
+
+``consul.host`` may also be a list of agents or servers, given as ``host``
+or ``host:port``. Reads are then spread over them, round robin or to the
+one with the lowest observed latency, and an endpoint that fails to answer
+or answers with a server error is skipped for ``consul.eject_for`` seconds,
+the request moving on to the next one. Writes and consistent reads
+stick to one healthy endpoint, in the order listed.
+
+.. code-block:: yaml
+
+    consul.host:
+      - consul1.example.com
+      - consul2.example.com:8600
+    consul.balance: latency
+    consul.eject_for: 30
+
+Reads made through ``key_get`` and ``key_exists`` can optionally be served
+from snapshots of whole key prefixes persisted under the minion cachedir.
+Snapshots younger than ``consul.cache_ttl`` seconds are served without
+contacting consul. Older ones are refreshed on the next read, but are still
+served when consul cannot be reached, until they reach
+``consul.cache_max_age`` seconds. This keeps renders working while the
+local agent is down or restarting. Scheduling ``consul.cache_refresh``
+keeps snapshots fresh without renders waiting on consul. Snapshots are
+always read from the configured agent with the configured token, so calls
+passing ``host``, ``port``, ``token``, ``consistency`` or ``dc`` bypass them.
+
+.. code-block:: yaml
+
+    consul.cache: True
+    consul.cache_prefixes:
+      - config/
+      - apps/myapp/
+    consul.cache_ttl: 60
+    consul.cache_max_age: 86400
+
+    schedule:
+      consul_cache_refresh:
+        function: consul.cache_refresh
+        seconds: 60
+
+Values can optionally go through a codec layer, enabled per call with
+``codec=True`` or for every write with ``consul.codec``. Values of at
+least ``consul.codec_threshold`` bytes are compressed with zlib, and values
+still larger than ``consul.codec_shard_size`` bytes are split across chunk
+keys under ``<key>.shards/`` with a manifest stored in the key itself.
+Encoded keys are tagged in the KV flags field and are decoded by
+``key_get`` whether or not the codec is enabled.
+
+.. code-block:: yaml
+
+    consul.codec: True
+    consul.codec_threshold: 4096
+    consul.codec_shard_size: 262144
 '''
 
+import io
 import os
+import gzip
+import json
+import re
+import time
+import zlib
+import logging
+import base64
+import hashlib
+import itertools
+import threading
+import multiprocessing.pool
 import salt.utils
+import salt.utils.atomicfile
+import salt.payload
 import codecs
 
 # Import third party libs
 HAS_CONSUL = False
 try:
     import consul as consul
+    import requests
     HAS_CONSUL = True
 except ImportError:
     pass
 
+HAS_ZSTD = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    pass
+
+log = logging.getLogger(__name__)
+
 __virtualname__ = 'consul'
 
+# Codec encoded values carry _CODEC_MAGIC in the upper bits of their flags
+_CODEC_MAGIC = 0x53430000
+_CODEC_MASK = 0xffff0000
+_CODEC_ZLIB = 0x1
+_CODEC_MANIFEST = 0x2
+_SHARD_SUFFIX = '.shards/'
+# Chunk keys and folders of sharded values, <key>.shards/<sha256>/NNNNNNNN
+_SHARD_KEY = re.compile(r'\.shards/[0-9a-f]{64}/([0-9]{8})?$')
+
+# Consul rejects transactions with bodies over 512KB, keep well under it
+_TXN_MAX_BYTES = 384 * 1024
+
+# base uri -> {'latency': smoothed seconds, 'ejected_until': timestamp}
+_ENDPOINTS = {}
+_ENDPOINTS_LOCK = threading.Lock()
+_ROUND_ROBIN = itertools.count()
+
+# Arguments which make a call bypass the snapshot cache
+_CACHE_BYPASS_ARGS = ('host', 'port', 'token', 'consistency', 'dc')
+
 
 def __virtual__():
     '''
@@ -41,19 +139,747 @@ def __virtual__():
         return False
 
 
-def _connect(host='localhost', port=8500, consistency='default', token=None, **kwargs):
+def _endpoints(host, port):
+    '''
+    Returns a list of (host, port) from a host, a comma separated string of
+    them, or a list of them, each optionally suffixed with :port
+    '''
+    if not isinstance(host, list):
+        host = str(host).split(',')
+    endpoints = []
+    for item in host:
+        item = str(item).strip()
+        if ':' in item:
+            item, item_port = item.rsplit(':', 1)
+            endpoints.append((item, int(item_port)))
+        else:
+            endpoints.append((item, int(port)))
+    return endpoints
+
+
+class _EndpointError(Exception):
+    '''
+    Raised when an endpoint answers with a server error, so the request is
+    retried elsewhere
+    '''
+
+
+class _BalancedHTTPClient(object):
+    '''
+    Stands in for the python-consul HTTP client, spreading requests over
+    several endpoints. Endpoint health and latency are shared by every
+    client in the process.
+    '''
+    def __init__(self, endpoints, balance='round_robin', eject_for=30):
+        self.clients = [consul.std.HTTPClient(host, port) for host, port in endpoints]
+        self.balance = balance
+        self.eject_for = float(eject_for)
+
+    def _state(self, client):
+        return _ENDPOINTS.setdefault(client.base_uri, {'latency': 0.0, 'ejected_until': 0})
+
+    def _candidates(self, pinned):
+        '''
+        Returns the clients in the order they should be tried. Ejected
+        endpoints go last rather than away, in case all of them are down.
+        '''
+        now = time.time()
+        with _ENDPOINTS_LOCK:
+            if pinned:
+                ordered = list(self.clients)
+            elif self.balance == 'latency':
+                ordered = sorted(self.clients, key=lambda client: self._state(client)['latency'])
+            else:
+                start = next(_ROUND_ROBIN) % len(self.clients)
+                ordered = self.clients[start:] + self.clients[:start]
+            healthy = [client for client in ordered if self._state(client)['ejected_until'] <= now]
+            ejected = [client for client in ordered if self._state(client)['ejected_until'] > now]
+        return healthy + sorted(ejected, key=lambda client: self._state(client)['ejected_until'])
+
+    def _send(self, client, method, callback, path, params, data):
+        if method == 'stream':
+            response = requests.get(client.uri(path, params), stream=True)
+            if response.status_code >= 500:
+                response.close()
+                raise _EndpointError('%s %s' % (response.status_code, response.text))
+            return response
+
+        def checked(response):
+            if response.code >= 500:
+                raise _EndpointError('%s %s' % (response.code, response.body))
+            return callback(response)
+
+        if method == 'get':
+            return client.get(checked, path, params=params)
+        if method == 'put':
+            return client.put(checked, path, params=params, data=data)
+        if method == 'delete':
+            return client.delete(checked, path, params=params)
+        return checked(client.response(requests.post(client.uri(path, params), data=data)))
+
+    def _request(self, method, callback, path, params=None, data=''):
+        query = dict(params or [])
+        pinned = method != 'get' or 'consistent' in query
+        error = None
+        for client in self._candidates(pinned):
+            start = time.time()
+            try:
+                ret = self._send(client, method, callback, path, params, data)
+            except (requests.exceptions.RequestException, _EndpointError) as exc:
+                log.warning('Consul endpoint %s failed, ejecting it for %ss: %s',
+                            client.base_uri, self.eject_for, exc)
+                with _ENDPOINTS_LOCK:
+                    self._state(client)['ejected_until'] = time.time() + self.eject_for
+                error = exc
+                continue
+            # blocking queries say nothing about latency
+            if 'index' not in query:
+                with _ENDPOINTS_LOCK:
+                    state = self._state(client)
+                    elapsed = time.time() - start
+                    state['latency'] = elapsed if not state['latency'] else 0.8 * state['latency'] + 0.2 * elapsed
+            return ret
+        if isinstance(error, _EndpointError):
+            raise consul.ConsulException(str(error))
+        raise error
+
+    def get(self, callback, path, params=None):
+        return self._request('get', callback, path, params)
+
+    def put(self, callback, path, params=None, data=''):
+        return self._request('put', callback, path, params, data)
+
+    def post(self, callback, path, params=None, data=''):
+        return self._request('post', callback, path, params, data)
+
+    def delete(self, callback, path, params=None):
+        return self._request('delete', callback, path, params)
+
+    def stream(self, path, params=None):
+        return self._request('stream', None, path, params)
+
+
+def _connect(host=None, port=None, consistency=None, token=None, **kwargs):
     '''
     Returns an instance of the consul client
     '''
     if not host:
-        host = __salt__['config.option']('consul.host')
+        host = __salt__['config.option']('consul.host') or 'localhost'
     if not port:
-        port = __salt__['config.option']('consul.port')
+        port = __salt__['config.option']('consul.port') or 8500
     if not consistency:
-        consistency = __salt__['config.option']('consul.consistency')
+        consistency = __salt__['config.option']('consul.consistency') or 'default'
     if not token:
-        token = __salt__['config.option']('consul.token')
-    return consul.Consul(host, port, consistency)
+        token = __salt__['config.option']('consul.token') or None
+    endpoints = _endpoints(host, port)
+    c = consul.Consul(endpoints[0][0], endpoints[0][1], token=token, consistency=consistency)
+    if len(endpoints) > 1:
+        c.http = _BalancedHTTPClient(endpoints,
+                                     __salt__['config.option']('consul.balance') or 'round_robin',
+                                     __salt__['config.option']('consul.eject_for') or 30)
+    return c
+
+
+def _http_get(c, path, params=None):
+    '''
+    Issues a GET for an endpoint python-consul does not wrap, returning a
+    tuple of (index, data). Data is None if consul answers 404.
+    '''
+    params = list(params or [])
+    if c.token:
+        params.append(('token', c.token))
+
+    def callback(response):
+        if response.code == 404:
+            return response.headers.get('X-Consul-Index'), None
+        if response.code == 403:
+            raise consul.ACLPermissionDenied(response.body)
+        if response.code >= 400:
+            raise consul.ConsulException('%s %s' % (response.code, response.body))
+        return response.headers.get('X-Consul-Index'), json.loads(response.body)
+
+    return c.http.get(callback, path, params=params)
+
+
+def _body_callback(response):
+    '''
+    Decodes the body of a response to a write, or None if it is empty
+    '''
+    if response.code == 403:
+        raise consul.ACLPermissionDenied(response.body)
+    if response.code >= 400:
+        raise consul.ConsulException('%s %s' % (response.code, response.body))
+    if not response.body:
+        return None
+    return json.loads(response.body)
+
+
+def _http_put(c, path, params=None, data=''):
+    '''
+    Issues a PUT for an endpoint python-consul does not wrap, returning the
+    decoded response body
+    '''
+    params = list(params or [])
+    if c.token:
+        params.append(('token', c.token))
+    return c.http.put(_body_callback, path, params=params, data=data)
+
+
+def _http_post(c, path, params=None, data=''):
+    '''
+    Issues a POST, returning the decoded response body
+    '''
+    params = list(params or [])
+    if c.token:
+        params.append(('token', c.token))
+    if hasattr(c.http, 'post'):
+        return c.http.post(_body_callback, path, params=params, data=data)
+    # python-consul 0.3.5 only speaks GET, PUT and DELETE
+    return _body_callback(c.http.response(requests.post(c.http.uri(path, params), data=data)))
+
+
+def _http_delete(c, path, params=None):
+    '''
+    Issues a DELETE, returning the decoded response body
+    '''
+    params = list(params or [])
+    if c.token:
+        params.append(('token', c.token))
+    return c.http.delete(_body_callback, path, params=params)
+
+
+def _http_stream(c, path, params=None):
+    '''
+    Issues a GET and returns the undecoded requests response, for reading
+    a large body piece by piece. Returns None if consul answers 404.
+    '''
+    params = list(params or [])
+    if c.token:
+        params.append(('token', c.token))
+    if hasattr(c.http, 'stream'):
+        response = c.http.stream(path, params)
+    else:
+        response = requests.get(c.http.uri(path, params), stream=True)
+    if response.status_code == 404:
+        response.close()
+        return None
+    if response.status_code == 403:
+        raise consul.ACLPermissionDenied(response.text)
+    if response.status_code >= 400:
+        raise consul.ConsulException('%s %s' % (response.status_code, response.text))
+    return response
+
+
+def _iter_json_array(chunks):
+    '''
+    Incrementally parses a JSON array of objects from an iterable of byte
+    chunks, yielding each element as soon as it is complete. Only the
+    element being parsed is held in memory.
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n[,':
+                pos += 1
+            if pos >= len(buf) or buf[pos] == ']':
+                break
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the element is not complete yet
+                break
+            yield item
+        buf = buf[pos:]
+    if buf.strip() not in ('', ']'):
+        raise consul.ConsulException('Truncated JSON response')
+
+
+def _kv_stream(c, prefix, dc=None):
+    '''
+    Yields the raw entries under prefix, values still base64 encoded, from
+    one streamed recursive read
+    '''
+    response = _http_stream(c, '/v1/kv/' + prefix, [('recurse', '1')] + _dc_params(dc))
+    if response is None:
+        return
+    try:
+        for entry in _iter_json_array(response.iter_content(65536)):
+            yield entry
+    finally:
+        response.close()
+
+
+def _dc_params(dc):
+    '''
+    Returns query parameters selecting a datacenter
+    '''
+    if dc:
+        return [('dc', dc)]
+    return []
+
+
+def _txn(c, ops, dc=None):
+    '''
+    Applies a list of operations in one transaction. Returns a tuple of
+    (results, errors); a rolled back transaction has results of None.
+    '''
+    params = []
+    if dc:
+        params.append(('dc', dc))
+    if c.token:
+        params.append(('token', c.token))
+
+    def callback(response):
+        if response.code == 403:
+            raise consul.ACLPermissionDenied(response.body)
+        if response.code not in (200, 409):
+            raise consul.ConsulException('%s %s' % (response.code, response.body))
+        body = json.loads(response.body)
+        return body.get('Results'), body.get('Errors') or []
+
+    return c.http.put(callback, '/v1/txn', params=params, data=json.dumps(ops))
+
+
+def _kv_keys(c, prefix, separator=None, dc=None):
+    '''
+    Returns the sorted names of the keys under prefix without their values
+    '''
+    params = [('keys', '1')]
+    if separator:
+        params.append(('separator', separator))
+    if dc:
+        params.append(('dc', dc))
+    index, keys = _http_get(c, '/v1/kv/' + prefix, params)
+    return keys or []
+
+
+def _open_stream(path, mode):
+    '''
+    Opens a binary file, compressed according to its extension
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith('.zst'):
+        if not HAS_ZSTD:
+            raise consul.ConsulException('zstandard is required to handle ' + path)
+        if 'r' in mode:
+            # the decompression reader cannot be iterated line by line itself
+            return io.BufferedReader(zstandard.open(path, mode))
+        return zstandard.open(path, mode)
+    return salt.utils.fopen(path, mode)
+
+
+def _cache_options():
+    '''
+    Returns the snapshot cache settings from the minion configuration
+    '''
+    return {'enabled': __salt__['config.option']('consul.cache', False),
+            'prefixes': __salt__['config.option']('consul.cache_prefixes', []) or [],
+            'ttl': float(__salt__['config.option']('consul.cache_ttl', 60)),
+            'max_age': float(__salt__['config.option']('consul.cache_max_age', 86400))}
+
+
+def _cache_prefix(key, **kwargs):
+    '''
+    Returns the longest configured cache prefix covering key, or None.
+    Snapshots only hold the configured cluster as seen with the configured
+    token, so calls overriding the connection or asking for another
+    datacenter or consistency mode bypass them.
+    '''
+    opts = _cache_options()
+    if not opts['enabled']:
+        return None
+    for arg in _CACHE_BYPASS_ARGS:
+        if kwargs.get(arg):
+            return None
+    matches = [prefix for prefix in opts['prefixes'] if key.startswith(prefix)]
+    if not matches:
+        return None
+    return max(matches, key=len)
+
+
+def _cache_file(prefix):
+    '''
+    Returns the path of the snapshot file for a prefix
+    '''
+    name = hashlib.sha1(prefix.encode('utf-8')).hexdigest()
+    return os.path.join(__opts__['cachedir'], 'consul', 'kv', name + '.p')
+
+
+def _cache_load(prefix):
+    '''
+    Returns the snapshot for a prefix, or None if there is no usable one.
+    Snapshots are kept in __context__ until the file on disk changes.
+    '''
+    path = _cache_file(prefix)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    context_key = 'consul.cache.' + prefix
+    if context_key in __context__ and __context__[context_key][0] == mtime:
+        return __context__[context_key][1]
+    try:
+        with salt.utils.fopen(path, 'rb') as fh_:
+            snapshot = salt.payload.Serial(__opts__).load(fh_)
+    except Exception as exc:
+        log.warning('Unable to read consul cache snapshot %s: %s', path, exc)
+        return None
+    __context__[context_key] = (mtime, snapshot)
+    return snapshot
+
+
+def _cache_store(snapshot):
+    '''
+    Atomically writes a snapshot to disk. Failing to do so only costs the
+    cache, so it is logged rather than failing the call consul answered.
+    '''
+    path = _cache_file(snapshot['prefix'])
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        with salt.utils.atomicfile.atomic_open(path, 'wb') as fh_:
+            salt.payload.Serial(__opts__).dump(snapshot, fh_)
+        __context__['consul.cache.' + snapshot['prefix']] = (os.path.getmtime(path), snapshot)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to write consul cache snapshot %s: %s', path, exc)
+    return snapshot
+
+
+def _cache_refresh(prefix):
+    '''
+    Fetches a prefix recursively from the configured consul and stores it as
+    a snapshot
+    '''
+    c = _connect()
+    index, entries = c.kv.get(prefix, recurse=True)
+    snapshot = {'prefix': prefix, 'index': index, 'time': time.time(), 'data': {}}
+    for entry in entries or []:
+        snapshot['data'][entry['Key']] = {'Flags': entry.get('Flags', 0),
+                                          'Value': entry.get('Value')}
+    return _cache_store(snapshot)
+
+
+def _cache_update(key, entry=None, recurse=False, **kwargs):
+    '''
+    Applies a write made through this module to the covering snapshot, so
+    later reads do not see the old value. An entry of None removes the key.
+    '''
+    prefix = _cache_prefix(key, **kwargs)
+    if prefix is None:
+        return
+    snapshot = _cache_load(prefix)
+    if snapshot is None:
+        return
+    if recurse:
+        for cached in [k for k in snapshot['data'] if k.startswith(key)]:
+            del snapshot['data'][cached]
+    elif entry is None:
+        snapshot['data'].pop(key, None)
+    else:
+        snapshot['data'][key] = {'Flags': entry.get('Flags', 0),
+                                 'Value': entry.get('Value')}
+    _cache_store(snapshot)
+
+
+def _cache_snapshot(prefix):
+    '''
+    Returns a snapshot of prefix that is usable under the configured ttl and
+    max_age. Expired snapshots are refreshed, but one younger than max_age
+    is still served if consul cannot be reached.
+    '''
+    opts = _cache_options()
+    snapshot = _cache_load(prefix)
+    age = time.time() - snapshot['time'] if snapshot else None
+    if snapshot is None or age >= opts['max_age']:
+        snapshot = _cache_refresh(prefix)
+    elif age >= opts['ttl']:
+        try:
+            snapshot = _cache_refresh(prefix)
+        except (consul.ConsulException, requests.exceptions.RequestException) as exc:
+            log.warning('Unable to refresh consul cache for "%s", serving a %ds old snapshot: %s',
+                        prefix, age, exc)
+    return snapshot
+
+
+def _kv_get(c, key, recurse=False, dc=None):
+    '''
+    Reads a key or a prefix like c.kv.get, also honouring dc, which
+    python-consul 0.3.5 does not support for kv reads
+    '''
+    if not dc:
+        return c.kv.get(key, recurse=recurse)
+    params = _dc_params(dc)
+    if recurse:
+        params.append(('recurse', '1'))
+    index, data = _http_get(c, '/v1/kv/' + key, params)
+    for entry in data or []:
+        if entry.get('Value') is not None:
+            entry['Value'] = base64.b64decode(entry['Value'])
+    if data and not recurse:
+        data = data[0]
+    return index, data
+
+
+def _is_shard(key, keys=()):
+    '''
+    Returns whether a key is a chunk key of a sharded value, or, in a
+    listing with a separator, the folder holding the chunks of one of keys
+    '''
+    if _SHARD_KEY.search(key):
+        return True
+    return key.endswith(_SHARD_SUFFIX) and key[:-len(_SHARD_SUFFIX)] in keys
+
+
+def _kv_entry(key, **kwargs):
+    '''
+    Returns the raw consul entry for key, or None if it does not exist.
+    Served from the snapshot cache when one covers the key.
+    '''
+    prefix = _cache_prefix(key, **kwargs)
+    if prefix is not None:
+        snapshot = _cache_snapshot(prefix)
+        entry = snapshot['data'].get(key)
+        if entry is None:
+            return None
+        return dict(entry, Key=key)
+
+    c = _connect(**kwargs)
+    index, data = _kv_get(c, key, dc=kwargs.get('dc'))
+    return data
+
+
+def _kv_entries(prefix, **kwargs):
+    '''
+    Returns the raw consul entries under prefix. Served from the snapshot
+    cache when one covers the whole prefix.
+    '''
+    cache_prefix = _cache_prefix(prefix, **kwargs)
+    if cache_prefix is not None:
+        snapshot = _cache_snapshot(cache_prefix)
+        entries = []
+        for key in sorted(snapshot['data']):
+            if key.startswith(prefix):
+                entries.append(dict(snapshot['data'][key], Key=key))
+        return entries
+
+    c = _connect(**kwargs)
+    index, entries = _kv_get(c, prefix, recurse=True, dc=kwargs.get('dc'))
+    return entries or []
+
+
+def _codec_options():
+    '''
+    Returns the codec settings from the minion configuration
+    '''
+    return {'enabled': __salt__['config.option']('consul.codec', False),
+            'threshold': int(__salt__['config.option']('consul.codec_threshold', 4096)),
+            'shard_size': int(__salt__['config.option']('consul.codec_shard_size', 262144))}
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _codec_flags(entry):
+    '''
+    Returns the codec bits of an entry, or None if it was not encoded
+    '''
+    flags = (entry or {}).get('Flags') or 0
+    if flags & _CODEC_MASK != _CODEC_MAGIC:
+        return None
+    return flags & ~_CODEC_MASK
+
+
+def _codec_manifest(entry):
+    '''
+    Returns the manifest stored in a sharded entry, or None
+    '''
+    flags = _codec_flags(entry)
+    if flags is None or not flags & _CODEC_MANIFEST:
+        return None
+    return json.loads(_to_bytes(entry['Value']).decode('utf-8'))
+
+
+def _codec_put(c, key, value):
+    '''
+    Writes a value through the codec. Oversize values are written as
+    content addressed chunks first, then the manifest replaces the previous
+    value and the previous chunks are dropped in one transaction, so readers
+    never see a partial value.
+    '''
+    opts = _codec_options()
+    raw = _to_bytes(value)
+    digest = hashlib.sha256(raw).hexdigest()
+    flags = _CODEC_MAGIC
+    data = raw
+    if len(raw) >= opts['threshold']:
+        data = zlib.compress(raw)
+        flags |= _CODEC_ZLIB
+
+    prefix = None
+    if len(data) > opts['shard_size']:
+        # chunks only depend on the encoded data and the shard size, so a
+        # prefix named after both can be reused as is
+        layout = hashlib.sha256(data)
+        layout.update(str(opts['shard_size']).encode('ascii'))
+        prefix = '%s%s%s/' % (key, _SHARD_SUFFIX, layout.hexdigest())
+
+    ops = []
+    index, current = c.kv.get(key)
+    old_manifest = _codec_manifest(current)
+    if old_manifest and old_manifest['prefix'] != prefix:
+        ops.append({'KV': {'Verb': 'delete-tree', 'Key': old_manifest['prefix']}})
+
+    if prefix is not None:
+        manifest = {'digest': digest,
+                    'size': len(raw),
+                    'prefix': prefix,
+                    'chunks': 0}
+        for start in range(0, len(data), opts['shard_size']):
+            chunk_key = '%s%08d' % (manifest['prefix'], manifest['chunks'])
+            c.kv.put(chunk_key, data[start:start + opts['shard_size']])
+            manifest['chunks'] += 1
+        data = json.dumps(manifest).encode('utf-8')
+        flags |= _CODEC_MANIFEST
+
+    ops.append({'KV': {'Verb': 'set',
+                       'Key': key,
+                       'Flags': flags,
+                       'Value': base64.b64encode(data).decode('ascii')}})
+    results, errors = _txn(c, ops)
+    if results is None:
+        raise consul.ConsulException('Unable to write %s: %s' % (key, errors))
+
+
+def _plain_put(c, key, value):
+    '''
+    Writes a value as is. If the key held a sharded value, its chunks are
+    dropped in the same transaction as the write so none are orphaned.
+    '''
+    index, current = c.kv.get(key)
+    manifest = _codec_manifest(current)
+    if not manifest:
+        return c.kv.put(key, value)
+
+    op = {'Verb': 'set', 'Key': key, 'Flags': 0}
+    if value is not None:
+        op['Value'] = base64.b64encode(_to_bytes(value)).decode('ascii')
+    results, errors = _txn(c, [{'KV': op},
+                               {'KV': {'Verb': 'delete-tree', 'Key': manifest['prefix']}}])
+    if results is None:
+        raise consul.ConsulException('Unable to write %s: %s' % (key, errors))
+    return True
+
+
+def _codec_decode(entry, **kwargs):
+    '''
+    Returns the value of an entry, decoded if the codec wrote it
+    '''
+    flags = _codec_flags(entry)
+    if flags is None:
+        return entry['Value']
+
+    data = entry['Value']
+    manifest = _codec_manifest(entry)
+    if manifest:
+        names = ['%s%08d' % (manifest['prefix'], i) for i in range(manifest['chunks'])]
+        chunks = dict([(chunk['Key'], chunk) for chunk in _kv_entries(manifest['prefix'], **kwargs)])
+        if [name for name in names if name not in chunks]:
+            # the snapshot cache may predate the chunks, ask consul itself
+            c = _connect(**kwargs)
+            index, found = _kv_get(c, manifest['prefix'], recurse=True, dc=kwargs.get('dc'))
+            chunks = dict([(chunk['Key'], chunk) for chunk in found or []])
+        missing = [name for name in names if name not in chunks]
+        if missing:
+            raise consul.ConsulException('Missing chunk %s of %s' % (missing[0], entry['Key']))
+        data = b''.join([_to_bytes(chunks[name]['Value'] or b'') for name in names])
+    if flags & _CODEC_ZLIB:
+        data = zlib.decompress(_to_bytes(data))
+    if manifest and hashlib.sha256(data).hexdigest() != manifest['digest']:
+        raise consul.ConsulException('Digest mismatch reassembling %s' % entry['Key'])
+    return data
+
+
+def key_digest(key, **kwargs):
+    '''
+    Returns the sha256 hex digest of the value of a key, False if it does
+    not exist. Sharded values are answered from their manifest without
+    fetching the chunks.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.key_digest foo
+    '''
+    data = _kv_entry(key, **kwargs)
+    if not data:
+        return False
+    manifest = _codec_manifest(data)
+    if manifest:
+        return manifest['digest']
+    return hashlib.sha256(_to_bytes(_codec_decode(data, **kwargs) or b'')).hexdigest()
+
+
+def cache_refresh(prefix=None):
+    '''
+    Refreshes the on-disk snapshots of the configured cache prefixes, or of
+    a single prefix. Returns the consul index of each refreshed snapshot.
+    Suitable for running from the minion scheduler to keep snapshots warm.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.cache_refresh
+
+        salt '*' consul.cache_refresh prefix=config/
+    '''
+    if prefix is None:
+        prefixes = _cache_options()['prefixes']
+    else:
+        prefixes = [prefix]
+    ret = {}
+    for item in prefixes:
+        ret[item] = _cache_refresh(item)['index']
+    return ret
+
+
+def cache_invalidate(prefix=''):
+    '''
+    Invalidates the snapshots overlapping a key prefix, or all of them, by
+    removing them. The next read under a removed snapshot fetches it again,
+    so an invalidation fired at a whole fleet does not send every minion to
+    consul at the same moment, and stale values are never served after it.
+    Returns the invalidated cache prefixes.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.cache_invalidate config/myapp/
+    '''
+    invalidated = []
+    for cache_prefix in _cache_options()['prefixes']:
+        if not (cache_prefix.startswith(prefix) or prefix.startswith(cache_prefix)):
+            continue
+        __context__.pop('consul.cache.' + cache_prefix, None)
+        try:
+            os.remove(_cache_file(cache_prefix))
+        except OSError:
+            continue
+        invalidated.append(cache_prefix)
+    return invalidated
 
 
 def key_delete(key, recurse=None, **kwargs):
@@ -71,7 +897,12 @@ def key_delete(key, recurse=None, **kwargs):
     if not data:
         return False
     else:
-        return c.kv.delete(key, recurse)
+        ret = c.kv.delete(key, recurse)
+        manifest = _codec_manifest(data)
+        if manifest and not recurse:
+            c.kv.delete(manifest['prefix'], True)
+        _cache_update(key, recurse=recurse, **kwargs)
+        return ret
 
 
 def key_exists(key, **kwargs):
@@ -84,43 +915,104 @@ def key_exists(key, **kwargs):
 
         salt '*' consul.key_exists foo
     '''
-    c = _connect(**kwargs)
-    index, data = c.kv.get(key)
+    data = _kv_entry(key, **kwargs)
     if not data:
         return False
     else:
         return True
         
 
-def key_get(key, **kwargs):
+def key_get(key, recurse=False, **kwargs):
     '''
-    Gets the value of the key in consul
+    Gets the value of the key in consul. With recurse, returns a dict of
+    every key under the prefix and its value.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' consul.key_get foo
+
+        salt '*' consul.key_get foo/ recurse=True
     '''
-    c = _connect(**kwargs)
-    index, data = c.kv.get(key)
+    if recurse:
+        values = {}
+        for entry in _kv_entries(key, **kwargs):
+            if not _is_shard(entry['Key']):
+                values[entry['Key']] = _codec_decode(entry, **kwargs)
+        return values
+
+    data = _kv_entry(key, **kwargs)
     if not data:
         return False
     else:
-        return data['Value']
+        return _codec_decode(data, **kwargs)
 
 
-def key_put(key, value, value_from_file=False, encoding='utf8', **kwargs):
+def key_list(prefix='', separator=None, dc=None, **kwargs):
     '''
-    Sets the value of a key in consul
+    List the keys under a prefix without fetching their values. With a
+    separator, keys are only listed up to the next separator after the
+    prefix, like listing a directory.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.key_list foo/
+
+        salt '*' consul.key_list foo/ separator=/
+    '''
+    c = _connect(**kwargs)
+    keys = _kv_keys(c, prefix, separator, dc)
+    return [key for key in keys if not _is_shard(key, keys)]
+
+
+def key_iter(prefix, decode=True, dc=None, **kwargs):
+    '''
+    Iterate over the keys and values under a prefix. The recursive read is
+    streamed and parsed incrementally, and each value is decoded only as its
+    entry is yielded, so huge prefixes can be scanned in bounded memory.
+    Returns a generator of single item dicts mapping each key to its entry,
+    with ``Flags`` and ``Value``; with decode=False values are left base64
+    encoded as consul sent them.
+
+    The minion merges the yielded dicts into one return, so the CLI below
+    works against minions. salt-call cannot return generators; from other
+    modules or templates iterate over the result instead.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.key_iter foo/
+    '''
+    c = _connect(**kwargs)
+    for entry in _kv_stream(c, prefix, dc):
+        if _is_shard(entry['Key']):
+            continue
+        if decode and entry.get('Value') is not None:
+            entry['Value'] = base64.b64decode(entry['Value'])
+            entry['Value'] = _codec_decode(entry, dc=dc, **kwargs)
+        yield {entry['Key']: entry}
+
+
+def key_put(key, value, value_from_file=False, encoding='utf8', codec=None, **kwargs):
+    '''
+    Sets the value of a key in consul. With codec, large values are
+    compressed and oversize ones sharded, see the module documentation.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' consul.key_put foo bar
+
+        salt '*' consul.key_put foo /path/to/large/file value_from_file=True codec=True
     '''
     c = _connect(**kwargs)
+    if codec is None:
+        codec = _codec_options()['enabled']
 
     if value_from_file:
         if not os.path.isfile(value):
@@ -135,13 +1027,189 @@ def key_put(key, value, value_from_file=False, encoding='utf8', **kwargs):
 
         else:
             file_contents = codecs.open(value, 'rb', encoding=encoding).read()
-            c.kv.put(key, file_contents)
+            if codec:
+                _codec_put(c, key, file_contents)
+            else:
+                _plain_put(c, key, file_contents)
 
+    elif codec:
+        _codec_put(c, key, value)
     else:
-        c.kv.put(key, value)
+        _plain_put(c, key, value)
 
     index, data = c.kv.get(key)
-    return data['Value']
+    _cache_update(key, data, **kwargs)
+    return _codec_decode(data, **kwargs)
+
+
+def _kv_raw_batch(c, keys, dc=None):
+    '''
+    Returns the raw entries, values still base64 encoded, of a batch of
+    keys. Keys that do not exist are left out.
+    '''
+    keys = list(keys)
+    while keys:
+        ops = [{'KV': {'Verb': 'get', 'Key': key}} for key in keys]
+        results, errors = _txn(c, ops, dc)
+        if results is not None:
+            return [result['KV'] for result in results]
+        # a get on a missing key rolls back the whole transaction, and the
+        # errors name every op that failed, so retry without those keys
+        failed = set([error['OpIndex'] for error in errors])
+        if not failed:
+            raise consul.ConsulException('Transaction rolled back without errors')
+        keys = [key for i, key in enumerate(keys) if i not in failed]
+    return []
+
+
+def kv_export(prefix, path, dc=None, **kwargs):
+    '''
+    Export every key under a prefix to a JSON lines file, compressed with
+    gzip or zstd when path ends in ``.gz`` or ``.zst``. The prefix is read
+    in one streamed request and each key is written out as it arrives, so
+    memory use does not grow with the size of the tree.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.kv_export config/ /srv/backup/config.jsonl.gz
+    '''
+    c = _connect(**kwargs)
+    count = 0
+    with _open_stream(path, 'wb') as fh_:
+        for entry in _kv_stream(c, prefix, dc):
+            line = {'Key': entry['Key'],
+                    'Flags': entry.get('Flags', 0),
+                    'Value': entry.get('Value')}
+            fh_.write(json.dumps(line).encode('utf-8') + b'\n')
+            count += 1
+    return {'path': path, 'keys': count}
+
+
+def _kv_op_size(line):
+    '''
+    Returns roughly how many bytes an exported entry adds to a transaction
+    '''
+    return len(line['Key']) + len(line.get('Value') or '') + 128
+
+
+def _kv_import_put(c, op, dc):
+    '''
+    Writes one op too large for a transaction with a plain put. Returns a
+    tuple of (results, errors) like _txn.
+    '''
+    params = [('flags', op['Flags'])] + _dc_params(dc)
+    if op['Verb'] == 'cas':
+        params.append(('cas', op['Index']))
+    value = ''
+    if op.get('Value') is not None:
+        value = base64.b64decode(op['Value'])
+    if _http_put(c, '/v1/kv/' + op['Key'], params, value):
+        return [op], []
+    return None, [{'OpIndex': 0, 'What': 'cas failed for %s' % op['Key']}]
+
+
+def _kv_import_batch(c, batch, cas, dry_run, dc, ret, diff_limit):
+    '''
+    Compares and writes one batch of exported entries, updating ret. A
+    batch consul refuses is counted as failed rather than aborting the
+    import, since earlier batches are already written.
+    '''
+    try:
+        current = {}
+        if cas or dry_run:
+            for entry in _kv_raw_batch(c, [line['Key'] for line in batch], dc):
+                current[entry['Key']] = entry
+
+        ops = []
+        changes = []
+        for line in batch:
+            entry = current.get(line['Key'])
+            if not (cas or dry_run):
+                change = 'written'
+            elif entry is None:
+                change = 'created'
+            elif entry.get('Value') == line.get('Value') and entry.get('Flags', 0) == line.get('Flags', 0):
+                ret['unchanged'] += 1
+                continue
+            else:
+                change = 'updated'
+            changes.append((line['Key'], change))
+            op = {'Verb': 'set', 'Key': line['Key'], 'Flags': line.get('Flags', 0)}
+            if line.get('Value') is not None:
+                op['Value'] = line['Value']
+            if cas:
+                op['Verb'] = 'cas'
+                op['Index'] = entry['ModifyIndex'] if entry else 0
+            ops.append({'KV': op})
+
+        if ops and not dry_run:
+            if len(ops) == 1 and _kv_op_size(ops[0]['KV']) > _TXN_MAX_BYTES:
+                results, errors = _kv_import_put(c, ops[0]['KV'], dc)
+            else:
+                results, errors = _txn(c, ops, dc)
+            if results is None:
+                ret['failed'] += len(ops)
+                ret['errors'].extend([error.get('What') for error in errors])
+                return
+    except consul.ConsulException as exc:
+        log.warning('Unable to import a batch of %s keys: %s', len(batch), exc)
+        ret['failed'] += len(batch)
+        ret['errors'].append(str(exc))
+        return
+    for key, change in changes:
+        ret[change] += 1
+        if dry_run and len(ret['changes']) < diff_limit:
+            ret['changes'][key] = change
+
+
+def kv_import(path, cas=False, dry_run=False, batch_size=64, diff_limit=1000, dc=None, **kwargs):
+    '''
+    Import a file written by kv_export, streaming it in transactions of up
+    to batch_size keys, kept under the transaction size consul accepts.
+    Values too large for a transaction are written with a put of their own.
+    Keys are written blindly unless cas or dry_run is set. Batches consul
+    refuses are counted in ``failed`` with their reason in ``errors``.
+
+    cas
+        compare each batch against consul first, skip unchanged keys and
+        only write keys nobody modified since they were compared. A batch
+        with a conflicting key is rolled back and counted as failed.
+
+    dry_run
+        only report what would be created or updated, listing up to
+        diff_limit keys
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.kv_import /srv/backup/config.jsonl.gz
+
+        salt '*' consul.kv_import /srv/backup/config.jsonl.gz cas=True dry_run=True
+    '''
+    c = _connect(**kwargs)
+    ret = {'written': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0, 'errors': []}
+    if dry_run:
+        ret['changes'] = {}
+    batch = []
+    size = 0
+    with _open_stream(path, 'rb') as fh_:
+        for raw in fh_:
+            if not raw.strip():
+                continue
+            line = json.loads(raw.decode('utf-8'))
+            line_size = _kv_op_size(line)
+            if batch and (len(batch) >= int(batch_size) or size + line_size > _TXN_MAX_BYTES):
+                _kv_import_batch(c, batch, cas, dry_run, dc, ret, diff_limit)
+                batch = []
+                size = 0
+            batch.append(line)
+            size += line_size
+    if batch:
+        _kv_import_batch(c, batch, cas, dry_run, dc, ret, diff_limit)
+    return ret
 
 
 def service_list(catalog=False, dc=None, index=None, **kwargs):
@@ -292,6 +1360,160 @@ def get_service_status(name,index=None, passing=None, **kwargs):
     return node_list
 
 
+# Check statuses from best to worst
+_HEALTH_STATUSES = ['passing', 'warning', 'critical']
+
+
+def _worst_status(*statuses):
+    '''
+    Returns the worst of the given check statuses
+    '''
+    worst = 'passing'
+    for status in statuses:
+        if status not in _HEALTH_STATUSES:
+            status = 'critical'
+        if _HEALTH_STATUSES.index(status) > _HEALTH_STATUSES.index(worst):
+            worst = status
+    return worst
+
+
+def _health_summary(checks, tag=None, since_index=None):
+    '''
+    Aggregates a list of health checks into per-service counts of instances
+    and per-node counts of checks by status
+    '''
+    node_status = {}
+    instances = {}
+    for check in checks:
+        if not check.get('ServiceID'):
+            node_status[check['Node']] = _worst_status(node_status.get(check['Node'], 'passing'),
+                                                       check['Status'])
+            continue
+        if tag and tag not in (check.get('ServiceTags') or []):
+            continue
+        instance = (check['ServiceName'], check['Node'], check['ServiceID'])
+        instances[instance] = _worst_status(instances.get(instance, 'passing'), check['Status'])
+
+    summary = {'services': {}, 'nodes': {}}
+    for (service, node, service_id), status in instances.items():
+        # node level checks such as serfHealth apply to every instance on the node
+        status = _worst_status(status, node_status.get(node, 'passing'))
+        counts = summary['services'].setdefault(service, dict.fromkeys(_HEALTH_STATUSES, 0))
+        counts[status] += 1
+
+    for check in checks:
+        if tag and check.get('ServiceID') and tag not in (check.get('ServiceTags') or []):
+            continue
+        counts = summary['nodes'].setdefault(check['Node'], dict.fromkeys(_HEALTH_STATUSES, 0))
+        counts[_worst_status(check['Status'])] += 1
+
+    if since_index is not None:
+        summary['changed'] = []
+        for check in checks:
+            if int(check.get('ModifyIndex', 0)) > int(since_index):
+                summary['changed'].append({'node': check['Node'],
+                                           'check': check['CheckID'],
+                                           'service': check.get('ServiceName', ''),
+                                           'status': check['Status']})
+    return summary
+
+
+def health_overview(dc=None, tag=None, node_meta=None, since_index=None, **kwargs):
+    '''
+    Summarize the health of every service and node in a datacenter from a
+    single query per datacenter, instead of one get_service_status per
+    service. Services are counted per instance by their worst check, nodes
+    per check.
+
+    dc
+        datacenter to summarize, a list of them, or ``all``. Defaults to the
+        agent's datacenter.
+
+    tag
+        only count service instances carrying this tag
+
+    node_meta
+        only count nodes with this metadata, as a dict or ``key:value``
+
+    since_index
+        index returned by a previous call; checks modified since then are
+        listed under ``changed``
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.health_overview
+
+        salt '*' consul.health_overview dc=all tag=web
+
+        salt '*' consul.health_overview node_meta=rack:r1 since_index=1234
+    '''
+    c = _connect(**kwargs)
+    params = []
+    if isinstance(node_meta, dict):
+        for meta_key, meta_value in node_meta.items():
+            params.append(('node-meta', '%s:%s' % (meta_key, meta_value)))
+    elif node_meta:
+        params.append(('node-meta', node_meta))
+
+    if dc == 'all':
+        dcs = c.catalog.datacenters()
+    elif isinstance(dc, list):
+        dcs = dc
+    else:
+        dcs = [dc]
+
+    ret = {}
+    for datacenter in dcs:
+        dc_params = list(params)
+        if datacenter:
+            dc_params.append(('dc', datacenter))
+        index, checks = _http_get(c, '/v1/health/state/any', dc_params)
+        summary = _health_summary(checks or [], tag, since_index)
+        summary['index'] = index
+        ret[datacenter] = summary
+
+    if dc is None:
+        return ret[None]
+    return ret
+
+
+def service_health(name, dc=None, tag=None, index=None, wait=None, **kwargs):
+    '''
+    Count the passing instances of a service, each judged by its worst
+    check including node checks. Given the index returned by a previous
+    call, blocks until the service's health changes or wait (e.g. ``30s``)
+    expires, so callers can react to changes as they happen.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.service_health foo
+
+        salt '*' consul.service_health foo index=1234 wait=30s
+    '''
+    c = _connect(**kwargs)
+    params = _dc_params(dc)
+    if tag:
+        params.append(('tag', tag))
+    if index:
+        params.append(('index', index))
+        if wait:
+            params.append(('wait', wait))
+    index, entries = _http_get(c, '/v1/health/service/%s' % name, params)
+
+    ret = {'index': index, 'passing': 0, 'total': 0, 'instances': {}}
+    for entry in entries or []:
+        status = _worst_status(*[check['Status'] for check in entry['Checks']])
+        ret['instances']['%s/%s' % (entry['Node']['Node'], entry['Service']['ID'])] = status
+        ret['total'] += 1
+        if status == 'passing':
+            ret['passing'] += 1
+    return ret
+
+
 def node_list(**kwargs):
     '''
     List nodes in Consul
@@ -341,6 +1563,382 @@ def dc_list(**kwargs):
     return c.catalog.datacenters()
 
 
+def _catalog_node(c, node, dc=None):
+    '''
+    Returns a node of the catalog with its services, or None
+    '''
+    index, data = _http_get(c, '/v1/catalog/node/%s' % node, _dc_params(dc))
+    return data
+
+
+def _catalog_register(c, body):
+    '''
+    Registers one catalog entry, keeping the node meta already set on its
+    node
+    '''
+    node = _catalog_node(c, body['Node'], body.get('Datacenter')) or {}
+    meta = dict((node.get('Node') or {}).get('Meta') or {})
+    meta.update(body['NodeMeta'])
+    body['NodeMeta'] = meta
+    _http_put(c, '/v1/catalog/register', data=json.dumps(body))
+
+
+def _catalog_deregister(c, body):
+    '''
+    Deregisters one catalog entry. An external node left without services
+    is removed as well, rather than lingering in the catalog.
+    '''
+    _http_put(c, '/v1/catalog/deregister', data=json.dumps(body))
+    if not body.get('ServiceID'):
+        return
+    node = _catalog_node(c, body['Node'], body.get('Datacenter'))
+    if node and not node.get('Services') and \
+            ((node.get('Node') or {}).get('Meta') or {}).get('external-node') == 'true':
+        body = dict(body)
+        del body['ServiceID']
+        _http_put(c, '/v1/catalog/deregister', data=json.dumps(body))
+
+
+def _catalog_apply(c, apply, bodies, concurrency):
+    '''
+    Calls apply(c, body) for each body from a pool of threads. Returns a
+    tuple of (number applied, {entry id: error}).
+    '''
+    def _apply(item):
+        entry_id, body = item
+        try:
+            apply(c, body)
+        except Exception as exc:
+            return entry_id, str(exc)
+        return entry_id, None
+
+    applied = 0
+    failed = {}
+    pool = multiprocessing.pool.ThreadPool(max(1, min(int(concurrency), len(bodies) or 1)))
+    try:
+        for entry_id, error in pool.imap_unordered(_apply, bodies):
+            if error is None:
+                applied += 1
+            else:
+                failed[entry_id] = error
+    finally:
+        pool.close()
+        pool.join()
+    return applied, failed
+
+
+def catalog_service(name, dc=None, tag=None, **kwargs):
+    '''
+    List every instance of a service in the catalog, including those of
+    external nodes without an agent
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.catalog_service foo
+    '''
+    c = _connect(**kwargs)
+    params = _dc_params(dc)
+    if tag:
+        params.append(('tag', tag))
+    index, entries = _http_get(c, '/v1/catalog/service/%s' % name, params)
+    return entries or []
+
+
+def catalog_register_many(entries, dc=None, concurrency=16, **kwargs):
+    '''
+    Register services of external nodes, which have no agent, directly in
+    the catalog. Entries are dicts with ``node``, ``address`` and
+    ``service``, and optionally ``service_id``, ``port``, ``tags`` and
+    ``service_address``. Registrations are sent concurrently from
+    ``concurrency`` threads. Nodes are tagged with the ``external-node``
+    node meta so they can be told apart from agent nodes; meta they already
+    carry is kept.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.catalog_register_many '[{node: db1, address: 10.0.0.5, service: mysql, port: 3306}]'
+    '''
+    c = _connect(**kwargs)
+    bodies = []
+    for entry in entries:
+        service = {'Service': entry['service'],
+                   'ID': entry.get('service_id') or entry['service']}
+        if entry.get('port') is not None:
+            service['Port'] = int(entry['port'])
+        if entry.get('tags') is not None:
+            service['Tags'] = entry['tags']
+        if entry.get('service_address') is not None:
+            service['Address'] = entry['service_address']
+        body = {'Node': entry['node'],
+                'Address': entry['address'],
+                'NodeMeta': {'external-node': 'true'},
+                'Service': service}
+        if dc:
+            body['Datacenter'] = dc
+        bodies.append(('%s/%s' % (entry['node'], service['ID']), body))
+    registered, failed = _catalog_apply(c, _catalog_register, bodies, concurrency)
+    return {'registered': registered, 'failed': failed}
+
+
+def catalog_deregister_many(entries, dc=None, concurrency=16, **kwargs):
+    '''
+    Remove entries from the catalog concurrently. Entries are dicts with
+    ``node`` and optionally ``service_id``; without one the whole node is
+    removed. External nodes left without services are removed too.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.catalog_deregister_many '[{node: db1, service_id: mysql}]'
+    '''
+    c = _connect(**kwargs)
+    bodies = []
+    for entry in entries:
+        body = {'Node': entry['node']}
+        if entry.get('service_id'):
+            body['ServiceID'] = entry['service_id']
+        if dc:
+            body['Datacenter'] = dc
+        bodies.append(('%s/%s' % (entry['node'], entry.get('service_id') or ''), body))
+    deregistered, failed = _catalog_apply(c, _catalog_deregister, bodies, concurrency)
+    return {'deregistered': deregistered, 'failed': failed}
+
+
+def query_definition(name, service, tags=None, only_passing=None, near=None,
+                     nearest_n=None, failover_dcs=None, dns_ttl=None, **kwargs):
+    '''
+    Return the prepared query definition query_create would send for the
+    given arguments, without contacting Consul
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_definition web web only_passing=True
+    '''
+    definition = {'Name': name, 'Service': {'Service': service}}
+    if tags is not None:
+        definition['Service']['Tags'] = tags
+    if only_passing is not None:
+        definition['Service']['OnlyPassing'] = only_passing
+    if near is not None:
+        definition['Service']['Near'] = near
+    if nearest_n is not None or failover_dcs is not None:
+        definition['Service']['Failover'] = {}
+        if nearest_n is not None:
+            definition['Service']['Failover']['NearestN'] = int(nearest_n)
+        if failover_dcs is not None:
+            definition['Service']['Failover']['Datacenters'] = failover_dcs
+    if dns_ttl is not None:
+        definition['DNS'] = {'TTL': dns_ttl}
+    return definition
+
+
+def query_list(dc=None, **kwargs):
+    '''
+    List prepared queries
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_list
+    '''
+    c = _connect(**kwargs)
+    index, queries = _http_get(c, '/v1/query', _dc_params(dc))
+    return queries or []
+
+
+def query_get(name, dc=None, **kwargs):
+    '''
+    Get a prepared query by name or ID
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_get web
+    '''
+    for query in query_list(dc=dc, **kwargs):
+        if name in (query['ID'], query.get('Name')):
+            return query
+    return False
+
+
+def query_create(name, service, tags=None, only_passing=None, near=None, nearest_n=None,
+                 failover_dcs=None, dns_ttl=None, dc=None, **kwargs):
+    '''
+    Create a prepared query, returns its ID. Sorting by round trip time from
+    a node (``near``, ``_agent`` for the calling agent) and failover to the
+    ``nearest_n`` or listed other datacenters are handled by the servers.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_create web web only_passing=True near=_agent nearest_n=2
+    '''
+    c = _connect(**kwargs)
+    definition = query_definition(name, service, tags, only_passing, near,
+                                  nearest_n, failover_dcs, dns_ttl)
+    return _http_post(c, '/v1/query', _dc_params(dc), json.dumps(definition))['ID']
+
+
+def query_update(name, service, tags=None, only_passing=None, near=None, nearest_n=None,
+                 failover_dcs=None, dns_ttl=None, dc=None, **kwargs):
+    '''
+    Update an existing prepared query, found by name or ID. Only the fields
+    query_definition manages are replaced, arguments left out unsetting
+    them; other fields, such as a Token or Template set outside of salt,
+    are kept.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_update web web failover_dcs='[dc2, dc3]'
+    '''
+    query = query_get(name, dc=dc, **kwargs)
+    if not query:
+        return False
+    c = _connect(**kwargs)
+    desired = query_definition(query.get('Name') or name, service, tags, only_passing,
+                               near, nearest_n, failover_dcs, dns_ttl)
+    definition = dict([(field, value) for field, value in query.items()
+                       if field not in ('ID', 'CreateIndex', 'ModifyIndex')])
+    definition['Name'] = desired['Name']
+    definition['Service'] = dict(query.get('Service') or {})
+    for field in ('Tags', 'OnlyPassing', 'Near', 'Failover'):
+        definition['Service'].pop(field, None)
+    definition['Service'].update(desired['Service'])
+    definition['DNS'] = dict(query.get('DNS') or {})
+    definition['DNS'].pop('TTL', None)
+    definition['DNS'].update(desired.get('DNS') or {})
+    _http_put(c, '/v1/query/' + query['ID'], _dc_params(dc), json.dumps(definition))
+    return True
+
+
+def query_delete(name, dc=None, **kwargs):
+    '''
+    Delete a prepared query, found by name or ID
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_delete web
+    '''
+    query = query_get(name, dc=dc, **kwargs)
+    if not query:
+        return False
+    c = _connect(**kwargs)
+    _http_delete(c, '/v1/query/' + query['ID'], _dc_params(dc))
+    return True
+
+
+def query_execute(name, dc=None, near=None, limit=None, cache_ttl=None, **kwargs):
+    '''
+    Execute a prepared query by name or ID and return the datacenter that
+    answered along with its healthy endpoints. Results are reused for
+    ``consul.query_cache_ttl`` seconds (default 5) within the same process,
+    so templates can resolve the same service repeatedly at no cost.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.query_execute web
+
+        salt '*' consul.query_execute web near=_agent limit=3 cache_ttl=0
+    '''
+    if cache_ttl is None:
+        cache_ttl = __salt__['config.option']('consul.query_cache_ttl', 5)
+    connection = [kwargs.get(arg) for arg in ('host', 'port', 'token', 'consistency')]
+    context_key = 'consul.query.%s' % ((name, dc, near, limit, connection),)
+    cached = __context__.get(context_key)
+    if cached and time.time() - cached[0] < float(cache_ttl):
+        return cached[1]
+
+    c = _connect(**kwargs)
+    params = _dc_params(dc)
+    if near:
+        params.append(('near', near))
+    if limit:
+        params.append(('limit', limit))
+    index, result = _http_get(c, '/v1/query/%s/execute' % name, params)
+    if result is None:
+        return False
+
+    ret = {'datacenter': result.get('Datacenter'),
+           'failovers': result.get('Failovers', 0),
+           'nodes': []}
+    for entry in result.get('Nodes') or []:
+        ret['nodes'].append({'node': entry['Node']['Node'],
+                             'address': entry['Service'].get('Address') or entry['Node']['Address'],
+                             'port': entry['Service'].get('Port'),
+                             'service_id': entry['Service'].get('ID'),
+                             'tags': entry['Service'].get('Tags') or []})
+    __context__[context_key] = (time.time(), ret)
+    return ret
+
+
+def event_fire(name, payload=None, node=None, service=None, tag=None, dc=None, **kwargs):
+    '''
+    Fire a user event, delivered to every agent matching the optional
+    node, service and tag filters (regular expressions). Returns the
+    event's ID.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.event_fire salt-invalidate payload=config/myapp/
+    '''
+    c = _connect(**kwargs)
+    params = _dc_params(dc)
+    for param, value in (('node', node), ('service', service), ('tag', tag)):
+        if value:
+            params.append((param, value))
+    return _http_put(c, '/v1/event/fire/%s' % name, params, payload or '')['ID']
+
+
+def event_list(name=None, index=None, wait=None, **kwargs):
+    '''
+    List the most recent user events seen by the agent, optionally only
+    those with a name, with their payloads decoded. Given the index returned
+    by a previous call, blocks until a new event arrives or wait (e.g.
+    ``5m``) expires.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' consul.event_list
+
+        salt '*' consul.event_list salt-invalidate
+    '''
+    c = _connect(**kwargs)
+    params = []
+    if name:
+        params.append(('name', name))
+    if index:
+        params.append(('index', index))
+        if wait:
+            params.append(('wait', wait))
+    index, events = _http_get(c, '/v1/event/list', params)
+
+    events = events or []
+    for event in events:
+        if event.get('Payload'):
+            event['Payload'] = base64.b64decode(event['Payload']).decode('utf-8', 'replace')
+    return {'index': index, 'events': events}
+
+
 def ttl_pass(name, notes=None, type='check', **kwargs):
     '''
     Mark a ttl-based service or check as passing
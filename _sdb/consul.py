@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+Consul SDB Module
+
+:maintainer: Aaron Bell <aarontbellgmail.com>
+:maturity: new
+:depends:    - python-consul (http://python-consul.readthedocs.org/en/latest/)
+:platform: Linux
+
+:configuration: This module uses the consul execution module for its
+    connection handling, so that module must be synced as well. Like all
+    sdb modules it is configured with a profile in the minion or master
+    configuration:
+
+.. code-block:: yaml
+
+    consul:
+      driver: consul
+      memoize_ttl: 10
+      prefetch:
+        - config/myapp/
+
+Values are then looked up with an ``sdb://`` uri:
+
+.. code-block:: yaml
+
+    password: sdb://consul/config/myapp/db/password
+
+Lookups are memoized in memory for ``memoize_ttl`` seconds, so repeated
+references to the same key within one render only reach consul once. The
+first lookup of a key under one of the ``prefetch`` prefixes reads the whole
+prefix in one call and memoizes every key in it.
+
+``host``, ``port``, ``consistency`` and ``token`` may be set in the profile
+to use another agent than the one configured for the consul module. Only
+lookups against the configured one are served from the consul module's
+snapshot cache, when it is enabled.
+'''
+
+import time
+
+__func_alias__ = {
+    'set_': 'set'
+}
+
+__virtualname__ = 'consul'
+
+# (connection, key) -> (expiry time, value)
+_MEMO = {}
+
+# (connection, prefix) -> expiry time
+_PREFETCHED = {}
+
+_CONNECTION_ARGS = ('host', 'port', 'consistency', 'token')
+
+# what the consul module connects with when they are not configured
+_CONNECTION_DEFAULTS = {'host': 'localhost', 'port': 8500, 'consistency': 'default', 'token': None}
+
+
+def __virtual__():
+    '''
+    Only load if the consul module is in __salt__
+    '''
+    if 'consul.key_get' in __salt__:
+        return __virtualname__
+    return False
+
+
+def _connection(profile):
+    '''
+    Returns the consul connection arguments from a profile. Those the
+    consul module is configured with already are left out, so that lookups
+    do not bypass its snapshot cache.
+    '''
+    conn = {}
+    for arg in _CONNECTION_ARGS:
+        value = (profile or {}).get(arg)
+        if not value:
+            continue
+        configured = __salt__['config.option']('consul.' + arg) or _CONNECTION_DEFAULTS[arg]
+        if str(value) != str(configured):
+            conn[arg] = value
+    return conn
+
+
+def _memo_key(conn, key):
+    return (tuple(sorted(conn.items())), key)
+
+
+def _prune(now):
+    '''
+    Drops expired memoized state, which long running masters would
+    otherwise accumulate
+    '''
+    for memo_key in [memo_key for memo_key, memo in _MEMO.items() if memo[0] <= now]:
+        del _MEMO[memo_key]
+    for memo_key in [memo_key for memo_key, expires in _PREFETCHED.items() if expires <= now]:
+        del _PREFETCHED[memo_key]
+
+
+def _forget(profile, key):
+    '''
+    Drops memoized state for a key about to be written, along with any
+    expired state
+    '''
+    _prune(time.time())
+    conn = _connection(profile)
+    _MEMO.pop(_memo_key(conn, key), None)
+    prefix = _prefetch_prefix(profile, key)
+    if prefix is not None:
+        _PREFETCHED.pop(_memo_key(conn, prefix), None)
+    return conn
+
+
+def _prefetch_prefix(profile, key):
+    '''
+    Returns the longest prefetch prefix covering key, or None
+    '''
+    prefixes = (profile or {}).get('prefetch') or []
+    if not isinstance(prefixes, list):
+        prefixes = [prefixes]
+    matches = [prefix for prefix in prefixes if key.startswith(prefix)]
+    if not matches:
+        return None
+    return max(matches, key=len)
+
+
+def get(key, profile=None):
+    '''
+    Get a value from consul, None if the key does not exist
+    '''
+    conn = _connection(profile)
+    now = time.time()
+    memo = _MEMO.get(_memo_key(conn, key))
+    if memo and memo[0] > now:
+        return memo[1]
+
+    expires = now + float((profile or {}).get('memoize_ttl', 10))
+    prefix = _prefetch_prefix(profile, key)
+    if prefix is not None and _PREFETCHED.get(_memo_key(conn, prefix), 0) > now:
+        # the whole prefix was read recently and the key was not in it
+        value = None
+    elif prefix is not None:
+        values = __salt__['consul.key_get'](prefix, recurse=True, **conn)
+        for item, value in values.items():
+            _MEMO[_memo_key(conn, item)] = (expires, value)
+        _PREFETCHED[_memo_key(conn, prefix)] = expires
+        value = values.get(key)
+    else:
+        value = __salt__['consul.key_get'](key, **conn)
+        if value is False:
+            value = None
+    _MEMO[_memo_key(conn, key)] = (expires, value)
+    return value
+
+
+def set_(key, value, profile=None):
+    '''
+    Set a key/value pair in consul
+    '''
+    conn = _forget(profile, key)
+    return __salt__['consul.key_put'](key, value, **conn)
+
+
+def delete(key, profile=None):
+    '''
+    Delete a key from consul
+    '''
+    conn = _forget(profile, key)
+    return __salt__['consul.key_delete'](key, **conn)
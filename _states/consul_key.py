@@ -35,6 +35,7 @@ overridden in states using the following arguments: ``host``, ``post``, ``consis
 __virtualname__ = 'consul_key'
 
 import os
+import hashlib
 import salt.utils
 
 def __virtual__():
@@ -55,6 +56,11 @@ def present(name, value, value_from_file=False, **kwargs):
 
     value
         Data to persist in key
+
+    codec
+        compress and shard large values, see :py:func:`consul.key_put`.
+        Existing values are compared by digest, so sharded values are not
+        downloaded to check them.
     '''
     ret = {'name': name,
            'changes': {},
@@ -78,12 +84,16 @@ def present(name, value, value_from_file=False, **kwargs):
     else:
         should = value
 
-    if not __salt__['consul.key_get'](name, **kwargs):
+    if not isinstance(should, bytes):
+        should = should.encode('utf-8')
+    digest = __salt__['consul.key_digest'](name, **kwargs)
+
+    if not digest:
         __salt__['consul.key_put'](name, value, value_from_file, **kwargs)
         ret['changes'][name] = 'Key created'
         ret['comment'] = 'Key "%s" set with value "%s"' % (name, value)
 
-    elif __salt__['consul.key_get'](name, **kwargs) != should:
+    elif digest != hashlib.sha256(should).hexdigest():
         __salt__['consul.key_put'](name, value, value_from_file, **kwargs)
         ret['changes'][name] = 'Value updated'
         ret['comment'] = 'Key "%s" updated with value "%s"' % (name, value)
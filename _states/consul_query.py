@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+Management of consul prepared queries
+==========================
+
+:maintainer: Aaron Bell <aarontbellgmail.com>
+:maturity: new
+:depends:    - python-consul (http://python-consul.readthedocs.org/en/latest/)
+:platform: Linux
+
+:depends:   - consul Python module
+:configuration: See :py:mod:`salt.modules.consul` for setup instructions.
+
+.. code-block:: yaml
+
+    query_in_consul:
+        consul_query.present:
+            - name: web
+            - service: web
+            - only_passing: True
+            - near: _agent
+            - nearest_n: 2
+
+    query_not_in_consul:
+        consul_query.absent:
+            - name: web
+
+'''
+
+__virtualname__ = 'consul_query'
+
+
+def __virtual__():
+    '''
+    Only load if the consul module is in __salt__
+    '''
+    if 'consul.query_create' in __salt__:
+        return __virtualname__
+    return False
+
+
+def _managed(definition):
+    '''
+    Returns the managed fields of a query definition, with unset fields
+    normalized to the defaults consul reports for them
+    '''
+    service = definition.get('Service') or {}
+    failover = service.get('Failover') or {}
+    dns = definition.get('DNS') or {}
+    return {'service': service.get('Service'),
+            'tags': sorted(service.get('Tags') or []),
+            'only_passing': bool(service.get('OnlyPassing')),
+            'near': service.get('Near') or '',
+            'nearest_n': int(failover.get('NearestN') or 0),
+            'failover_dcs': list(failover.get('Datacenters') or []),
+            'dns_ttl': dns.get('TTL') or ''}
+
+
+def present(name, service, tags=None, only_passing=None, near=None, nearest_n=None,
+            failover_dcs=None, dns_ttl=None, dc=None, **kwargs):
+    '''
+    Ensure the named prepared query is present in Consul. Arguments left
+    out are unset on the query, so removing one from the state removes it
+    from consul too.
+
+    name
+        consul prepared query to manage
+
+    service
+        service the query resolves
+
+    tags
+        list of tags instances must carry
+
+    only_passing
+        only return instances whose checks are all passing
+
+    near
+        node to sort results by round trip time from, ``_agent`` for the
+        agent executing the query
+
+    nearest_n + failover_dcs
+        number of nearest datacenters, and explicit list of datacenters, to
+        fail over to when no healthy instance is found locally
+
+    dns_ttl
+        ttl of DNS answers for this query
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': 'Query "%s" already up to date' % (name)}
+
+    args = (service, tags, only_passing, near, nearest_n, failover_dcs, dns_ttl)
+    query = __salt__['consul.query_get'](name, dc=dc, **kwargs)
+
+    if not query:
+        if __opts__['test']:
+            ret['result'] = None
+            ret['changes'][name] = 'Query would be created'
+            ret['comment'] = 'Query "%s" would be created' % (name)
+            return ret
+        __salt__['consul.query_create'](name, *args, dc=dc, **kwargs)
+        ret['changes'][name] = 'Query created'
+        ret['comment'] = 'Query "%s" created' % (name)
+
+    else:
+        desired = __salt__['consul.query_definition'](name, *args)
+        if _managed(desired) != _managed(query):
+            if __opts__['test']:
+                ret['result'] = None
+                ret['changes'][name] = {'old': _managed(query), 'new': _managed(desired)}
+                ret['comment'] = 'Query "%s" would be updated' % (name)
+                return ret
+            __salt__['consul.query_update'](name, *args, dc=dc, **kwargs)
+            ret['changes'][name] = 'Query updated'
+            ret['comment'] = 'Query "%s" updated' % (name)
+
+    return ret
+
+
+def absent(name, dc=None, **kwargs):
+    '''
+    Ensure the named prepared query is absent in Consul
+
+    name
+        consul prepared query to manage
+
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': 'Query "%s" removed' % (name)}
+
+    if not __salt__['consul.query_get'](name, dc=dc, **kwargs):
+        ret['comment'] = 'Query "%s" already absent' % (name)
+
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['changes'][name] = 'Query would be removed'
+        ret['comment'] = 'Query "%s" would be removed' % (name)
+
+    else:
+        __salt__['consul.query_delete'](name, dc=dc, **kwargs)
+        ret['changes'][name] = 'Query removed'
+
+    return ret
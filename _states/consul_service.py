@@ -32,8 +32,35 @@ Management of consul services
             - status: passing
             - notes: bar
 
+    service_healthy:
+        consul_service.healthy:
+            - name: foo
+            - percent: 75
+            - timeout: 300
+
+    external_service:
+        consul_service.external:
+            - name: mysql
+            - endpoints:
+                - node: db1
+                  address: 10.0.0.5
+                  port: 3306
+
 '''
 
+import time
+import logging
+
+# Import third party libs
+try:
+    import consul
+    import requests
+    _RETRY_ERRORS = (consul.ConsulException, requests.exceptions.RequestException)
+except ImportError:
+    _RETRY_ERRORS = ()
+
+log = logging.getLogger(__name__)
+
 __virtualname__ = 'consul_service'
 
 
@@ -143,3 +170,180 @@ def ttl_set(name, status, notes=None):
     
     return ret
 
+
+def healthy(name, count=None, percent=None, dc=None, tag=None, timeout=300, retry=5, **kwargs):
+    '''
+    Wait until enough instances of a service are passing their checks.
+    Uses blocking queries, so the state returns as soon as consul sees the
+    service become healthy rather than on a polling interval.
+
+    name
+        consul service to wait for
+
+    count
+        minimum number of passing instances, defaults to 1 when neither
+        count nor percent is given
+
+    percent
+        minimum percentage of instances passing
+
+    dc
+        datacenter to check, defaults to the agent's
+
+    tag
+        only consider instances carrying this tag
+
+    timeout
+        seconds to wait before failing
+
+    retry
+        seconds to wait before asking again when consul cannot be reached,
+        as happens while agents restart during a deploy
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+
+    if count is None and percent is None:
+        count = 1
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'Would wait up to %ss for service "%s" to be healthy' % (timeout, name)
+        return ret
+
+    deadline = time.time() + float(timeout)
+    index = None
+    status = 'no answer from consul'
+    while True:
+        remaining = int(deadline - time.time())
+        try:
+            health = __salt__['consul.service_health'](name, dc=dc, tag=tag, index=index,
+                                                        wait='%ss' % max(1, remaining), **kwargs)
+        except _RETRY_ERRORS as exc:
+            log.warning('Unable to get the health of service "%s", retrying: %s', name, exc)
+            status = 'last error: %s' % (exc)
+            health = None
+            index = None
+
+        if health is not None:
+            passing, total = health['passing'], health['total']
+            status = '%s of %s instances passing' % (passing, total)
+            if ((count is None or passing >= int(count)) and
+                    (percent is None or (total and passing * 100.0 / total >= float(percent)))):
+                ret['comment'] = 'Service "%s" healthy: %s' % (name, status)
+                return ret
+
+        if time.time() >= deadline:
+            ret['result'] = False
+            ret['comment'] = 'Timed out waiting for service "%s": %s' % (name, status)
+            return ret
+
+        if health is None:
+            time.sleep(max(0, min(float(retry), deadline - time.time())))
+        # an index going backwards means the servers were reset, start over
+        elif index and int(health['index']) < int(index):
+            index = None
+        else:
+            index = health['index']
+
+
+def _external_entries(name, endpoints):
+    '''
+    Returns the desired catalog entries keyed by (node, service id)
+    '''
+    entries = {}
+    for endpoint in endpoints:
+        entry = dict(endpoint, service=name)
+        entry['service_id'] = entry.get('service_id') or name
+        entries[(entry['node'], entry['service_id'])] = entry
+    return entries
+
+
+def _external_matches(entry, current):
+    '''
+    Return true if a catalog entry already matches a desired endpoint
+    '''
+    return (current['Address'] == entry['address'] and
+            (entry.get('port') is None or current.get('ServicePort') == int(entry['port'])) and
+            (entry.get('tags') is None or sorted(current.get('ServiceTags') or []) == sorted(entry['tags'])) and
+            (entry.get('service_address') is None or current.get('ServiceAddress') == entry['service_address']))
+
+
+def external(name, endpoints, dc=None, prune=True, concurrency=16, **kwargs):
+    '''
+    Ensure a service is registered in the catalog on exactly the given
+    external nodes, which have no agent. Only the entries that differ are
+    registered or removed, concurrently.
+
+    name
+        consul service to manage
+
+    endpoints
+        list of dicts with ``node`` and ``address``, and optionally
+        ``service_id``, ``port``, ``tags`` and ``service_address``
+
+    dc
+        datacenter to manage, defaults to the agent's
+
+    prune
+        deregister instances of the service on other external nodes, and
+        those nodes once they have no services left. Nodes running an agent
+        are never touched.
+
+    concurrency
+        number of registrations sent at once
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': 'Service "%s" external endpoints already in sync' % (name)}
+
+    desired = _external_entries(name, endpoints)
+    current = {}
+    for instance in __salt__['consul.catalog_service'](name, dc=dc, **kwargs):
+        current[(instance['Node'], instance['ServiceID'])] = instance
+
+    register = [entry for key, entry in desired.items()
+                if key not in current or not _external_matches(entry, current[key])]
+    deregister = []
+    if prune:
+        for (node, service_id), instance in current.items():
+            if (node, service_id) not in desired and \
+                    (instance.get('NodeMeta') or {}).get('external-node') == 'true':
+                deregister.append({'node': node, 'service_id': service_id})
+
+    if not register and not deregister:
+        return ret
+
+    changes = {}
+    if register:
+        changes['registered'] = sorted(['%s/%s' % (entry['node'], entry['service_id']) for entry in register])
+    if deregister:
+        changes['deregistered'] = sorted(['%s/%s' % (entry['node'], entry['service_id']) for entry in deregister])
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['changes'] = changes
+        ret['comment'] = 'Service "%s" would have %s endpoints registered and %s deregistered' % (
+            name, len(register), len(deregister))
+        return ret
+
+    failed = {}
+    if register:
+        failed.update(__salt__['consul.catalog_register_many'](register, dc=dc, concurrency=concurrency,
+                                                               **kwargs)['failed'])
+    if deregister:
+        failed.update(__salt__['consul.catalog_deregister_many'](deregister, dc=dc, concurrency=concurrency,
+                                                                 **kwargs)['failed'])
+
+    for change in changes:
+        changes[change] = [item for item in changes[change] if item not in failed]
+    ret['changes'] = changes
+    ret['comment'] = 'Service "%s" had %s endpoints registered and %s deregistered' % (
+        name, len(changes.get('registered', [])), len(changes.get('deregistered', [])))
+    if failed:
+        ret['result'] = False
+        ret['comment'] += ', %s failed: %s' % (len(failed), failed)
+    return ret